@@ -18,6 +18,7 @@ class _EventHistory(TypedDict):
 
 _EventUnion = Union[OrderEvent, FoodPrepEvent, CourierArrivalEvent, PickupEvent]
 _PrePickupInfo = Optional[tuple[FoodPrepEvent, CourierArrivalEvent]]
+_WaitingInfo = tuple[list[FoodPrepEvent], list[CourierArrivalEvent]]
 
 
 class Dispatcher(ABC):
@@ -102,6 +103,23 @@ class Dispatcher(ABC):
         # conversion (type) -> (type name) that happens here, ignore mypy error
         self.history[event.__class__.__name__].append(event)    # type: ignore[misc]
 
+    def _copyHistory(self, other: "Dispatcher") -> None:
+        """Replace the history with a copy of that of another Dispatcher, without printing anything. Used to reuse
+        the events of a previous run
+        """
+        self.history = {name: [*events] for name, events in other.history.items()}    # type: ignore[assignment]
+
+    def _getWaiting(self) -> _WaitingInfo:
+        """Returns the (prepared orders, arrived couriers) that are currently waiting for a match, in arrival order
+        """
+        raise NotImplementedError
+
+    def _setWaiting(self, foodPrepEvents: list[FoodPrepEvent], courierArrivalEvents: list[CourierArrivalEvent]) -> None:
+        """Replace the prepared orders and arrived couriers that are currently waiting for a match. Together with
+        _getWaiting, allows the matching state of a Dispatcher to be restored at any point of a recorded run
+        """
+        raise NotImplementedError
+
 class MatchedDispatcher(Dispatcher):
     """Dispatcher subclass that matches for pickup each courier with the order for which they were originally dispatched
     """
@@ -134,6 +152,13 @@ class MatchedDispatcher(Dispatcher):
             self.courierArrivalDict[oid] = event
             return None
 
+    def _getWaiting(self) -> _WaitingInfo:
+        return [*self.foodPrepDict.values()], [*self.courierArrivalDict.values()]
+
+    def _setWaiting(self, foodPrepEvents: list[FoodPrepEvent], courierArrivalEvents: list[CourierArrivalEvent]) -> None:
+        self.foodPrepDict = {event.order.id: event for event in foodPrepEvents}
+        self.courierArrivalDict = {event.order.id: event for event in courierArrivalEvents}
+
 class FifoDispatcher(Dispatcher):
     """Dispatcher subclass that matches for pickup each prepared order with the first available courier
     """
@@ -164,6 +189,18 @@ class FifoDispatcher(Dispatcher):
             self.courierArrivalQueue.put(event, block=False)
             return None
 
+    def _getWaiting(self) -> _WaitingInfo:
+        return [*self.foodPrepQueue.queue], [*self.courierArrivalQueue.queue]
+
+    def _setWaiting(self, foodPrepEvents: list[FoodPrepEvent], courierArrivalEvents: list[CourierArrivalEvent]) -> None:
+        self.foodPrepQueue = Queue()
+        for foodPrepEvent in foodPrepEvents:
+            self.foodPrepQueue.put(foodPrepEvent, block=False)
+
+        self.courierArrivalQueue = Queue()
+        for courierArrivalEvent in courierArrivalEvents:
+            self.courierArrivalQueue.put(courierArrivalEvent, block=False)
+
 class CapacityDispatcher(Dispatcher):
     """Dispatcher subclass that matches for pickup each prepared order with the first available courier
     """
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 import argparse
+from bisect import bisect_left
+from copy import copy
+from dataclasses import replace
 import numpy as np
 from os import PathLike
 from pathlib import Path
 from queue import PriorityQueue
 import time
-from typing import Optional, Union
+from typing import Any, Callable, Optional, Union
 
 from dispatch_sim.dispatcher import MatchedDispatcher, FifoDispatcher, CapacityDispatcher
 from dispatch_sim.event import Event, OrderEvent, FoodPrepEvent, CourierArrivalEvent, PickupEvent
@@ -13,17 +16,24 @@ from dispatch_sim.order import loadOrders, Order
 
 HERE = Path(__file__).resolve().parent
 
+# some type hint aliases
+_EventTriple = tuple[float, int, Event]
+_LogEntry = tuple[_EventTriple, list[_EventTriple]]
+
 
 class Sim:
     """Class that represents a real-time simulation of a simple order dispatch system. Provides the business logic
     for all of the explicitly "fake" aspects of the simulation. For example, initial generation of all Event instances
     (which normally would be eg received via appropriate REST endpoints), the real-time waits in between events, etc
     """
+    _addedTriples: list[_EventTriple]
     _dispatcher: Union[MatchedDispatcher, FifoDispatcher, CapacityDispatcher]
     _eventCount: int
-    _eventQueue: PriorityQueue[tuple[float, int, Event]]
+    _eventLog: list[_LogEntry]
+    _eventQueue: PriorityQueue[_EventTriple]
     _eta: Optional[float]
     _realtime: bool
+    _recordedLog: Optional[list[_LogEntry]]
 
     def __init__(self, capacity: bool=False, fifo: bool=False, timestamp: bool=False, _eta: Optional[float]=None, _realtime: bool=True):
         if fifo:
@@ -31,12 +41,15 @@ class Sim:
         elif capacity:
             self._dispatcher = CapacityDispatcher(timestamp=timestamp)
         else:
-            MatchedDispatcher(timestamp=timestamp)
+            self._dispatcher = MatchedDispatcher(timestamp=timestamp)
+        self._addedTriples = []
         self._eventCount = 0
+        self._eventLog = []
         self._eventQueue = PriorityQueue()
 
         self._eta = _eta
         self._realtime = _realtime
+        self._recordedLog = None
 
     def addOrder(self, order: Order, time: float) -> None:
         """Add a single order to the simulation, to be processed at the given time
@@ -70,28 +83,354 @@ class Sim:
                     time.sleep(nextEvent.time - now)
                     now = time.time() - t0
 
-            if isinstance(nextEvent, OrderEvent):
-                postOrderInfo = self._dispatcher.doOrder(event=nextEvent)
-                self._simulateOrderFollowup(postOrderInfo)
+            self._doEvent(nextEvent)
+
+        # print final stat summary message
+        print(self._dispatcher, end="\n\n")
+
+    def resimulate(self, orderId: str, prepTimeDelta: float=0, etaDelta: float=0) -> "Sim":
+        """Answer a "what if" question about a completed run: what if the order with the given id had a prepTime
+        longer by prepTimeDelta, and/or its courier had arrived etaDelta later. Returns a new Sim holding the
+        resulting run; this Sim is left untouched, so several questions can be asked of the same run.
+
+        Rather than redoing the whole run, the recorded event log and history are copied in bulk and only the
+        affected events are replayed (in discrete time, and reusing the random courier etas and capacities of the
+        recorded run):
+            - with a MatchedDispatcher, pickups of different orders are independent, so only the food prep, courier
+              arrival and pickup of the changed order are replayed and swapped into the copy
+            - with a FifoDispatcher, events are replayed from the earliest affected one until the queue and
+              dispatcher state converge back to those of the recorded run
+        Only the replayed events are printed. Runs that use a CapacityDispatcher can't be resimulated, since it
+        modifies courier arrival events in place and so the recorded run can't be restored
+        """
+        if isinstance(self._dispatcher, CapacityDispatcher):
+            raise ValueError("Runs that use a CapacityDispatcher can't be resimulated")
+
+        # find the changed order, along with the followup events that were put in response to it
+        for orderPos, ((_, orderCount, orderEvent), orderPuts) in enumerate(self._eventLog):
+            if isinstance(orderEvent, OrderEvent) and orderEvent.order.id == orderId:
+                break
+        else:
+            raise ValueError(f"No recorded order with id: {orderId}")
+
+        order = replace(orderEvent.order, prepTime=orderEvent.order.prepTime + prepTimeDelta)
+        if order.prepTime < 0:
+            raise ValueError(f"Order with id {orderId} would have a negative prepTime: {order.prepTime}")
 
-            elif isinstance(nextEvent, FoodPrepEvent):
-                prePickupInfo = self._dispatcher.doFoodPrep(event=nextEvent)
-                if prePickupInfo is not None:
-                    self._simulatePickup(*prePickupInfo)
+        # replacement event triples, keyed by their (unique) event count. The food prep time is computed exactly as
+        # in a full run, since any rounding difference could change how it ties with other events
+        replaced: dict[int, _EventTriple] = {
+            orderCount: (orderEvent.time, orderCount, replace(orderEvent, order=order)),
+        }
+        for eventTime, count, event in orderPuts:
+            if isinstance(event, FoodPrepEvent):
+                eventTime = orderEvent.time + order.prepTime
+            elif isinstance(event, CourierArrivalEvent):
+                eventTime += etaDelta
+                if eventTime < orderEvent.time:
+                    raise ValueError(f"Courier for order with id {orderId} would arrive before the order is placed")
+            replaced[count] = (eventTime, count, replace(event, time=eventTime, order=order))
 
-            elif isinstance(nextEvent, CourierArrivalEvent):
-                prePickupInfo = self._dispatcher.doCourierArrival(event=nextEvent)
-                if prePickupInfo is not None:
-                    self._simulatePickup(*prePickupInfo)
+        # the new run starts out as a copy of the recorded one, with the changed order event swapped in
+        sim = copy(self)
+        sim._addedTriples = [*self._addedTriples]
+        sim._dispatcher = type(self._dispatcher)(timestamp=self._dispatcher.timestamp)
+        sim._dispatcher._copyHistory(self._dispatcher)
+        sim._eventLog = [*self._eventLog]
+        sim._eventQueue = PriorityQueue()
+        sim._swapOrderEvent(orderPos, replaced)
 
-            elif isinstance(nextEvent, PickupEvent):
-                self._dispatcher.doPickup(event=nextEvent)
+        # a completed run puts nothing while processing its last event, so any puts recorded there were made after
+        # the run (eg by addOrder). Those stay queued, and get moved to the last entry of the new run
+        triple, postRunPuts = sim._eventLog[-1]
+        sim._eventLog[-1] = (triple, [])
 
+        if isinstance(self._dispatcher, MatchedDispatcher):
+            self._replayOrder(sim, orderPuts, [replaced[put[1]] for put in orderPuts])
+        else:
+            self._replayUntilConverged(sim, orderPuts, replaced)
+
+        # _putEvent only ever appends to the last entry, so that one mustn't be shared with the recorded run
+        triple, _ = sim._eventLog[-1]
+        sim._eventLog[-1] = (triple, [*postRunPuts])
+
+        return sim
+
+    def _swapOrderEvent(self, orderPos: int, replaced: dict[int, _EventTriple]) -> None:
+        """Swap the replaced version of the order event at orderPos, and of its followups, into the event log and
+        history of this Sim
+        """
+        (orderTime, orderCount, orderEvent), puts = self._eventLog[orderPos]
+        orderTriple = replaced[orderCount]
+
+        events = self._dispatcher.history["OrderEvent"]
+        events[self._historyIndex(self._eventLog, events, (orderTime, orderCount))] = orderTriple[2]
+        self._eventLog[orderPos] = (orderTriple, [replaced[put[1]] for put in puts])
+
+        if orderCount < len(self._addedTriples):
+            self._addedTriples[orderCount] = orderTriple
+        else:
+            # the order was added after a run, and so was recorded as a put of an earlier entry of the log
+            for pos in range(orderPos - 1, -1, -1):
+                triple, puts = self._eventLog[pos]
+                if any(put[1] == orderCount for put in puts):
+                    self._eventLog[pos] = (triple, [replaced.get(put[1], put) for put in puts])
+                    break
+
+    def _replayOrder(self, sim: "Sim", oldFollowups: list[_EventTriple], newFollowups: list[_EventTriple]) -> None:
+        """Replay only the events of a single changed order, and swap them into sim in place of the recorded ones.
+        Only valid for a MatchedDispatcher, which never matches an order with the courier of another order
+        """
+        log = self._eventLog
+
+        # the recorded food prep and courier arrival of the changed order, and the pickup put by whichever came last
+        oldPositions = [self._logIndex(log, triple[:2]) for triple in oldFollowups]
+        oldPickupPutPos = max(oldPositions)
+        oldPickup = log[oldPickupPutPos][1][0]
+        oldPositions.append(self._logIndex(log, oldPickup[:2]))
+
+        # the replayed pickup is put while processing whichever of the new food prep and courier arrival comes last,
+        # so a full run would give it the count of the first recorded put (other than the old pickup) after that
+        lastTime, lastCount = max(triple[:2] for triple in newFollowups)
+        newPickupPutPos = self._logIndex(log, (lastTime, lastCount + 1))
+        newCount = self._eventCount - len(log[-1][1])
+        for pos in range(newPickupPutPos, len(log)):
+            counts = [put[1] for put in log[pos][1] if put is not oldPickup]
+            if counts:
+                newCount = counts[0]
+                break
+
+        # moving the pickup shifts the counts of all puts made in between its recorded and replayed put steps
+        if newCount <= oldPickup[1]:
+            shift, window, pickupCount = 1, range(newCount, oldPickup[1]), newCount
+        else:
+            shift, window, pickupCount = -1, range(oldPickup[1] + 1, newCount), newCount - 1
+
+        def renumber(triple: _EventTriple) -> _EventTriple:
+            if triple[1] in window:
+                return (triple[0], triple[1] + shift, triple[2])
+            return triple
+
+        for pos in range(min(oldPickupPutPos, newPickupPutPos), min(max(oldPickupPutPos, newPickupPutPos) + 1, len(log))):
+            triple, puts = sim._eventLog[pos]
+            shifted = [put for put in puts if put[1] in window]
+            if not shifted:
+                continue
+            sim._eventLog[pos] = (triple, [renumber(put) for put in puts])
+
+            for put in shifted:
+                # also renumber where each shifted event got processed, unless it is still queued
+                putPos = self._logIndex(log, put[:2])
+                if putPos < len(log) and log[putPos][0][:2] == put[:2]:
+                    triple, puts = sim._eventLog[putPos]
+                    sim._eventLog[putPos] = (renumber(triple), puts)
+
+        # replay the changed order on its own
+        replay = copy(self)
+        replay._addedTriples = []
+        replay._dispatcher = MatchedDispatcher(timestamp=self._dispatcher.timestamp)
+        replay._eventCount = pickupCount
+        replay._eventLog = []
+        replay._eventQueue = PriorityQueue()
+        for triple in newFollowups:
+            replay._eventQueue.put(triple)
+        while not replay._eventQueue.empty():
+            replay._doEvent(replay._getEvent())
+
+        # swap the replayed events in for the recorded ones
+        history = sim._dispatcher.history
+        for pos in sorted(oldPositions, reverse=True):
+            (eventTime, count, event), _ = log[pos]
+            events = history[event.__class__.__name__]    # type: ignore[misc]
+            del events[self._historyIndex(log, events, (eventTime, count))]
+            del sim._eventLog[pos]
+
+        for triple, puts in replay._eventLog:
+            sim._eventLog.insert(self._logIndex(sim._eventLog, triple[:2]), (triple, puts))
+            events = history[triple[2].__class__.__name__]    # type: ignore[misc]
+            events.insert(self._historyIndex(sim._eventLog, events, triple[:2]), triple[2])
+
+        sim._dispatcher._setWaiting(*self._dispatcher._getWaiting())
+        sim._eventCount = self._eventCount
+        for triple in self._eventQueue.queue:
+            sim._eventQueue.put(renumber(triple))
+
+    def _replayUntilConverged(self, sim: "Sim", orderPuts: list[_EventTriple], replaced: dict[int, _EventTriple]) -> None:
+        """Replay events into sim from the earliest affected one onwards, stepping the recorded run alongside, until
+        both have the same queue and dispatcher state. The rest of the recorded run is then reused as is
+        """
+        log = self._eventLog
+
+        def sub(triple: _EventTriple) -> _EventTriple:
+            return replaced.get(triple[1], triple)
+
+        # events are processed in (time, count) order, so the replay starts at the first step that comes at or after
+        # either the original or the changed version of any of the followup events
+        start = self._logIndex(log, min(min(triple[:2], sub(triple)[:2]) for triple in orderPuts))
+
+        # cut the copied log and history back to just before the start step
+        history = sim._dispatcher.history
+        if start < len(log):
+            for events in history.values():
+                del events[self._historyIndex(sim._eventLog, events, log[start][0][:2]):]    # type: ignore[attr-defined]
+        del sim._eventLog[start:]
+
+        # restore the queue and dispatcher state of the recorded run as it was just before the start step, without a
+        # pass over the whole prefix. The queue held everything put before then (ie with a lower count than the first
+        # put from then on) that was processed after
+        eventCount = self._eventCount - len(log[-1][1])
+        for pos in range(start, len(log)):
+            if log[pos][1]:
+                eventCount = log[pos][1][0][1]
+                break
+        pending = {triple[1]: triple for triple, _ in log[start:] if triple[1] < eventCount}
+        pending.update((triple[1], triple) for triple in self._eventQueue.queue if triple[1] < eventCount)
+
+        # the food preps and couriers left waiting were processed before then, but matched after. A FifoDispatcher
+        # matches them in order, before any processed later, so scan ahead only until that happens for both kinds
+        waiting: dict[type, list[Any]] = {FoodPrepEvent: [], CourierArrivalEvent: []}
+        resolved: set[type] = set()
+        for pos in range(start, len(log)):
+            (_, _, event), puts = log[pos]
+            if not isinstance(event, (FoodPrepEvent, CourierArrivalEvent)):
+                continue
+            pickup = next((put[2] for put in puts if isinstance(put[2], PickupEvent)), None)
+            if pickup is None:
+                # nothing of the opposite kind was left waiting
+                resolved.add(CourierArrivalEvent if isinstance(event, FoodPrepEvent) else FoodPrepEvent)
             else:
-                raise NotImplementedError
+                partner = pickup.courierArrivalEvent if isinstance(event, FoodPrepEvent) else pickup.foodPrepEvent
+                if partner.__class__ not in resolved and self._logPosition(log, partner) < start:
+                    waiting[partner.__class__].append(partner)
+                else:
+                    resolved.add(partner.__class__)
+            if len(resolved) == 2:
+                break
+        else:
+            # anything still waiting at the end of the recorded run was never matched
+            for events in self._dispatcher._getWaiting():
+                for event in events:
+                    if event.__class__ not in resolved and self._logPosition(log, event) < start:
+                        waiting[event.__class__].append(event)
+        foodPrepEvents: list[FoodPrepEvent] = waiting[FoodPrepEvent]
+        courierArrivalEvents: list[CourierArrivalEvent] = waiting[CourierArrivalEvent]
 
-        # print final stat summary message
-        print(self._dispatcher, end="\n\n")
+        sim._dispatcher._setWaiting(foodPrepEvents, courierArrivalEvents)
+        sim._eventCount = eventCount
+        for triple in pending.values():
+            sim._eventQueue.put(sub(triple))
+        sim._recordedLog = log
+
+        # once a put moves to a different step, the counts of all later puts differ between the two runs. So instead
+        # of comparing the queues directly, keep a running count of the difference between them, by event key
+        diff: dict[tuple[Any, ...], int] = {}
+
+        def shift(triple: _EventTriple, n: int) -> None:
+            key = self._eventKey(triple[2])
+            diff[key] = diff.get(key, 0) + n
+            if not diff[key]:
+                del diff[key]
+
+        for triple in pending.values():
+            if sub(triple) is not triple:
+                shift(sub(triple), 1)
+                shift(triple, -1)
+
+        converged = False
+        for step in range(start, len(log)):
+            if sim._eventQueue.empty():
+                break
+            sim._doEvent(sim._getEvent())
+            (replayTriple, replayPuts), (recordedTriple, recordedPuts) = sim._eventLog[-1], log[step]
+            shift(replayTriple, -1)
+            shift(recordedTriple, 1)
+            for put in replayPuts:
+                shift(put, 1)
+            for put in recordedPuts:
+                shift(put, -1)
+
+            self._advanceState(log[step], pending, foodPrepEvents, courierArrivalEvents)
+            eventCount += len(recordedPuts)
+
+            if diff or sim._eventCount != eventCount:
+                continue
+            if sim._dispatcher._getWaiting() != (foodPrepEvents, courierArrivalEvents):
+                continue
+
+            # the queues hold the same events, but they only get processed in the same order if the replayed counts
+            # sort the same way as the recorded counts
+            recordedCounts = {self._eventKey(triple[2]): triple[1] for triple in pending.values()}
+            countPairs = sorted((recordedCounts[self._eventKey(triple[2])], triple[1]) for triple in sim._eventQueue.queue)
+            if any(a[1] > b[1] for a, b in zip(countPairs, countPairs[1:])):
+                continue
+            countMap = dict(countPairs)
+
+            # converged, so the remainder of the recorded run can be reused as is, once the counts of the events that
+            # were still queued are mapped to their replayed counts
+            if step + 1 < len(log):
+                restKey = log[step + 1][0][:2]
+                for name, events in self._dispatcher.history.items():
+                    history[name].extend(events[self._historyIndex(log, events, restKey):])    # type: ignore
+            offset = len(sim._eventLog) - (step + 1)
+            sim._eventLog.extend(log[step + 1:])
+            for recordedCount, replayCount in countPairs:
+                if recordedCount == replayCount:
+                    continue
+                eventTime = pending[recordedCount][0]
+                pos = self._logIndex(log, (eventTime, recordedCount))
+                if pos < len(log) and log[pos][0][1] == recordedCount:
+                    (_, _, event), puts = log[pos]
+                    sim._eventLog[pos + offset] = ((eventTime, replayCount, event), puts)
+
+            sim._eventQueue = PriorityQueue()
+            for eventTime, count, event in self._eventQueue.queue:
+                sim._eventQueue.put((eventTime, countMap.get(count, count), event))
+            converged = True
+            break
+
+        if not converged:
+            # the replay covered the whole recorded run, so only the events queued after it remain
+            for triple in self._eventQueue.queue:
+                sim._eventQueue.put(triple)
+
+        sim._dispatcher._setWaiting(*self._dispatcher._getWaiting())
+        sim._eventCount = self._eventCount
+        sim._recordedLog = None
+
+    def _doEvent(self, nextEvent: Event) -> None:
+        """Pass a single event to the relevant handler of the dispatcher, then simulate whatever follows from it
+        """
+        if isinstance(nextEvent, OrderEvent):
+            postOrderInfo = self._dispatcher.doOrder(event=nextEvent)
+            self._simulateOrderFollowup(postOrderInfo)
+
+        elif isinstance(nextEvent, FoodPrepEvent):
+            prePickupInfo = self._dispatcher.doFoodPrep(event=nextEvent)
+            if prePickupInfo is not None:
+                self._simulatePickup(*prePickupInfo)
+
+        elif isinstance(nextEvent, CourierArrivalEvent):
+            prePickupInfo = self._dispatcher.doCourierArrival(event=nextEvent)
+            if prePickupInfo is not None:
+                self._simulatePickup(*prePickupInfo)
+
+        elif isinstance(nextEvent, PickupEvent):
+            self._dispatcher.doPickup(event=nextEvent)
+
+        else:
+            raise NotImplementedError
+
+    @staticmethod
+    def _eventKey(event: Event) -> tuple[Any, ...]:
+        """Hashable key that identifies an event independently of its count. Only made of shallow fields so that it
+        is cheap to compute, plus for pickups the times and orders of their food prep and courier
+        """
+        key: tuple[Any, ...] = (event.__class__.__name__, event.time, event.order.id, event.order.prepTime)
+        if isinstance(event, PickupEvent):
+            courierArrivalEvent = event.courierArrivalEvent
+            key += (event.foodPrepEvent.time, courierArrivalEvent.time, courierArrivalEvent.order.id,
+                    courierArrivalEvent.order.prepTime)
+        return key
 
     def _getEta(self) -> float:
         if self._eta is None:
@@ -99,22 +438,95 @@ class Sim:
         else:
             return self._eta
 
+    @staticmethod
+    def _advanceState(entry: _LogEntry, pending: dict[int, _EventTriple], foodPrepEvents: list[FoodPrepEvent],
+                      courierArrivalEvents: list[CourierArrivalEvent]) -> None:
+        """Update a (queue, waiting food preps, waiting couriers) state to account for a single step of the event log
+        """
+        (_, count, event), puts = entry
+        del pending[count]
+        pending.update((put[1], put) for put in puts)
+
+        pickup = next((put[2] for put in puts if isinstance(put[2], PickupEvent)), None)
+        if isinstance(event, FoodPrepEvent):
+            if pickup is None:
+                foodPrepEvents.append(event)
+            else:
+                courierArrivalEvents.remove(pickup.courierArrivalEvent)
+        elif isinstance(event, CourierArrivalEvent):
+            if pickup is None:
+                courierArrivalEvents.append(event)
+            else:
+                foodPrepEvents.remove(pickup.foodPrepEvent)
+
+    @staticmethod
+    def _logIndex(log: list[_LogEntry], key: tuple[float, int]) -> int:
+        """Index of the first entry of an event log that was processed at or after the given (time, count) key.
+        Entries are (triple, puts) pairs, so a bare (key,) compares less than any entry with an equal key
+        """
+        return bisect_left(log, (key,))    # type: ignore[arg-type]
+
+    @staticmethod
+    def _logPosition(log: list[_LogEntry], event: Event) -> int:
+        """Index of the entry of an event log at which the given (or an equal) event was processed
+        """
+        pos = bisect_left(log, ((event.time,),))    # type: ignore[arg-type]
+        while log[pos][0][2] != event:
+            pos += 1
+        return pos
+
+    @classmethod
+    def _historyIndex(cls, log: list[_LogEntry], events: list[Any], key: tuple[float, int]) -> int:
+        """Index of the first event of a Dispatcher history list that was processed at or after the given
+        (time, count) key, according to an event log. History lists are in processing order, so this is a binary
+        search, which looks up counts in the log only for events with a tied time
+        """
+        lo, hi = 0, len(events)
+        while lo < hi:
+            mid = (lo + hi)//2
+            event = events[mid]
+            if event.time != key[0]:
+                before = event.time < key[0]
+            else:
+                before = log[cls._logPosition(log, event)][0][:2] < key
+            if before:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
     def _getEvent(self) -> Event:
         """Fetch the next event from the event queue, discarding the tuple entries used
-        for sorting
+        for sorting. The full triple is recorded in the event log
         """
-        _, _, event = self._eventQueue.get()
-        return event
+        triple = self._eventQueue.get()
+        self._eventLog.append((triple, []))
+        return triple[2]
 
     def _putEvent(self, event: Event) -> None:
         """Add an event to this Sim instance's event queue as a (eventTime, eventCount, event) triple. Storing objects
         as triples in a priority queue is a common approach that has several advantages (avoids object comparison,
         ensures stability in case of equal priority, etc). See: https://docs.python.org/3/library/heapq.html
         """
-        self._eventQueue.put((event.time, self._eventCount, event))
+        triple = (event.time, self._eventCount, event)
+        self._eventQueue.put(triple)
         self._eventCount += 1
 
+        # record which events get put in response to which, for use by resimulate. Events put outside of run (eg by
+        # calling addOrder after a run) are recorded as puts of the last processed event, since that is when they
+        # entered the queue
+        if self._eventLog:
+            self._eventLog[-1][1].append(triple)
+        else:
+            self._addedTriples.append(triple)
+
     def _simulateOrderFollowup(self, event: Event) -> None:
+        if self._recordedLog is not None:
+            # when resimulating, reuse the recorded followups instead of making new random draws
+            for _, _, followup in self._recordedLog[self._logPosition(self._recordedLog, event)][1]:
+                self._putEvent(followup)
+            return
+
         self._putEvent(
             # food prep event associated with this order event
             FoodPrepEvent(
@@ -1,4 +1,6 @@
+from dataclasses import replace
 from pathlib import Path
+import pytest
 
 from dispatch_sim.event import OrderEvent
 from dispatch_sim.sim import Sim
@@ -58,3 +60,113 @@ class TestSim:
         testSimLog, testSimErr = capsys.readouterr()
 
         assert self.realSimLog == testSimLog
+
+    def test_resimulate(self, capsys):
+        self.sim.addOrdersFromFile(ordersFpath, t0=17.5, tdelta=.5)
+        self.sim.run()
+        testSim = self.sim.resimulate(orders[0].id, prepTimeDelta=5)
+
+        # compare against a full run over the modified orders
+        realSim = Sim(fifo=True, _eta=9, _realtime=False)
+        for i, order in enumerate(orders):
+            realSim.addOrder(replace(order, prepTime=order.prepTime + 5) if i == 0 else order, 17.5 + i*.5)
+        realSim.run()
+
+        # courier capacities are random, so compare pickup times and history order
+        assert [(e.time, e.order) for e in realSim._dispatcher.history["PickupEvent"]] == \
+            [(e.time, e.order) for e in testSim._dispatcher.history["PickupEvent"]]
+        assert [triple[:2] for triple, _ in realSim._eventLog] == [triple[:2] for triple, _ in testSim._eventLog]
+
+    def test_resimulate_unchanged(self, capsys):
+        self.sim.addOrdersFromFile(ordersFpath, t0=17.5, tdelta=.5)
+        self.sim.run()
+        capsys.readouterr()
+        testSim = self.sim.resimulate(orders[2].id)
+        testSimLog, testSimErr = capsys.readouterr()
+
+        # the state converges immediately, so everything after the first replayed event is reused
+        assert testSimLog.count("\n\n") == 1
+        assert self.sim._dispatcher.history == testSim._dispatcher.history
+        assert self.sim._eventLog == testSim._eventLog
+
+    def test_resimulate_matched(self, capsys):
+        sim = Sim(_eta=9, _realtime=False)
+        sim.addOrdersFromFile(ordersFpath, t0=17.5, tdelta=.5)
+        sim.run()
+        testSim = sim.resimulate(orders[1].id, etaDelta=20)
+
+        realPickupTimes = {orders[0].id: 26.5, orders[1].id: 47.0, orders[2].id: 27.5}
+        assert realPickupTimes == {e.order.id: e.time for e in testSim._dispatcher.history["PickupEvent"]}
+        # the original run is left untouched
+        assert 41.0 == sim._dispatcher.history["PickupEvent"][-1].time
+
+    def test_resimulate_matched_replay(self, capsys):
+        sim = Sim(_eta=9, _realtime=False)
+        for i in range(50):
+            sim.addOrder(replace(orders[i % 3], id=str(i)), i*.5)
+        sim.run()
+        capsys.readouterr()
+        testSim = sim.resimulate("20", prepTimeDelta=5)
+        testSimLog, testSimErr = capsys.readouterr()
+
+        # only the food prep, courier arrival and pickup of the changed order are replayed
+        assert testSimLog.count("\n\n") == 3
+        assert len(sim._eventLog) == len(testSim._eventLog)
+        assert 19.0 == {e.order.id: e.time for e in testSim._dispatcher.history["PickupEvent"]}["20"]
+
+    def test_resimulate_matched_queued(self, capsys):
+        sim = Sim(_eta=9, _realtime=False)
+        sim.addOrder(replace(orders[0], id="a"), 0)
+        sim.addOrder(replace(orders[1], id="b"), .5)
+        sim.run()
+        sim.addOrder(replace(orders[2], id="c"), 50)
+        testSim = sim.resimulate("a", prepTimeDelta=1)
+
+        # an order added after the run is still queued in the returned Sim, and gets processed when it is run
+        assert ["c"] == [triple[2].order.id for triple in testSim._eventQueue.queue if isinstance(triple[2], OrderEvent)]
+        testSim.run()
+        assert "c" in {e.order.id for e in testSim._dispatcher.history["PickupEvent"]}
+
+    def test_resimulate_tie(self, capsys):
+        self.sim.addOrder(replace(orders[0], id="x", prepTime=.1), .1)
+        self.sim.addOrder(replace(orders[1], id="y", prepTime=.5), .1)
+        self.sim.run()
+        testSim = self.sim.resimulate("x", prepTimeDelta=.4)
+
+        # the changed food prep ties exactly with the other one, as it does in a full run
+        realSim = Sim(fifo=True, _eta=9, _realtime=False)
+        realSim.addOrder(replace(orders[0], id="x", prepTime=.5), .1)
+        realSim.addOrder(replace(orders[1], id="y", prepTime=.5), .1)
+        realSim.run()
+
+        assert [triple[:2] for triple, _ in realSim._eventLog] == [triple[:2] for triple, _ in testSim._eventLog]
+        for e in testSim._dispatcher.history["PickupEvent"]:
+            assert e.order.id == e.courierArrivalEvent.order.id
+
+    def test_resimulate_untouched(self, capsys):
+        self.sim.addOrdersFromFile(ordersFpath, t0=17.5, tdelta=.5)
+        self.sim.run()
+        realEventLog = [(triple, [*puts]) for triple, puts in self.sim._eventLog]
+        testSim = self.sim.resimulate(orders[2].id)
+
+        # the recorded run is reused as is, but adding to and running the returned Sim doesn't affect it
+        testSim.addOrder(orders[0], 50)
+        testSim.run()
+        assert realEventLog == self.sim._eventLog
+
+    def test_resimulate_errors(self, capsys):
+        self.sim.addOrdersFromFile(ordersFpath, t0=17.5, tdelta=.5)
+        self.sim.run()
+
+        with pytest.raises(ValueError, match="No recorded order"):
+            self.sim.resimulate("not-an-order-id")
+        with pytest.raises(ValueError, match="negative prepTime"):
+            self.sim.resimulate(orders[0].id, prepTimeDelta=-5)
+        with pytest.raises(ValueError, match="before the order is placed"):
+            self.sim.resimulate(orders[0].id, etaDelta=-10)
+
+        sim = Sim(capacity=True, _eta=9, _realtime=False)
+        sim.addOrdersFromFile(ordersFpath, t0=17.5, tdelta=.5)
+        sim.run()
+        with pytest.raises(ValueError, match="CapacityDispatcher"):
+            sim.resimulate(orders[0].id)